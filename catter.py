@@ -30,6 +30,7 @@ def main():
     cat = eventio.PopenHandler('__cat__', ['cat'])
     stdin = eventio.StdioHandler()
     stdin.on_stdin = cat.on_stdin
+    stdin.on_close = cat.close_stdin
     poller.add_handler(cat)
     poller.add_handler(stdin)
 
@@ -21,12 +21,7 @@
 
 
 import functools
-
-from . import poller, proccer, stdio, liner
-from .poller import Handler, Poller
-from .proccer import PopenHandler
-from .stdio import StdioHandler, StdioLineHandler
-from .liner import LineMixin
+import sys
 
 
 log =  functools.partial(print, 'info   :', flush=True)
@@ -35,16 +30,79 @@ loge = functools.partial(print, 'error  :', flush=True)
 logd = functools.partial(print, 'debug  :', flush=True)
 
 
+# Submodules are imported on first attribute access so short-lived tools
+# only pay for what they use.
+submodules = (
+    'poller',
+    'proccer',
+    'stdio',
+    'liner',
+    'shmer',
+    'capturer',
+    'signaler',
+)
+
+exports = {
+    'Handler': 'poller',
+    'Poller': 'poller',
+    'PRIO_HIGH': 'poller',
+    'PRIO_NORMAL': 'poller',
+    'PRIO_LOW': 'poller',
+    'PopenHandler': 'proccer',
+    'StdioHandler': 'stdio',
+    'StdioLineHandler': 'stdio',
+    'LineMixin': 'liner',
+    'ShmPopenHandler': 'shmer',
+    'ShmChildHandler': 'shmer',
+    'Capturer': 'capturer',
+    'CapturePopenHandler': 'capturer',
+    'SignalHandler': 'signaler',
+}
+
+__all__ = ('set_logfns',) + submodules + tuple(exports)
+
+logfns = None
+
+
+def apply_logfns():
+
+    if logfns is None:
+        return
+
+    for name in submodules:
+        module = sys.modules.get(f'{__name__}.{name}')
+        if module is not None:
+            module.set_logfns(*logfns)
+
+
+def __getattr__(name):
+
+    if name in submodules:
+        module_name = name
+    elif name in exports:
+        module_name = exports[name]
+    else:
+        raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
+
+    __import__(f'{__name__}.{module_name}')
+    module = sys.modules[f'{__name__}.{module_name}']
+
+    value = module if name in submodules else getattr(module, name)
+    globals()[name] = value
+
+    return value
+
+
+def __dir__():
+
+    return sorted(set(globals()) | set(submodules) | set(exports))
+
+
 def set_logfns(i, w, e, d):
 
-    log(f'setting log functions: {__name__}, {i}, {w}, {e}, {d}')
+    global logfns
 
-    modules = {
-        poller,
-        proccer,
-        stdio,
-        liner,
-    }
+    d(f'setting log functions: {__name__}, {i}, {w}, {e}, {d}')
 
-    for m in modules:
-        m.set_logfns(i, w, e, d)
+    logfns = (i, w, e, d)
+    apply_logfns()
@@ -0,0 +1,459 @@
+# Copyright 2021 "Dan Farrell <djfarrell@hopspan.com>"
+# 
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+# 
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+# 
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT.
+# IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY
+# CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT,
+# TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+
+import collections
+import functools
+import itertools
+import os
+import queue
+import re
+import struct
+import threading
+import zlib
+
+from . import proccer
+from . import logfns as package_logfns
+
+
+log =  functools.partial(print, 'info   :', flush=True)
+logw = functools.partial(print, 'warning:', flush=True)
+loge = functools.partial(print, 'error  :', flush=True)
+logd = functools.partial(print, 'debug  :', flush=True)
+
+
+def set_logfns(i, w, e, d):
+
+    global log
+    global logw
+    global loge
+    global logd
+
+    log = i
+    logw = w
+    loge = e
+    logd = d
+
+
+# Pick up log functions set on the package before this module was imported.
+if package_logfns is not None:
+    set_logfns(*package_logfns)
+
+
+class StreamCapture(object):
+
+    segment_header = struct.Struct('<QI')
+    compress_level = 1
+    open_flags = os.O_WRONLY | os.O_CREAT | os.O_TRUNC | os.O_APPEND
+
+    def __init__(self, name, base, spiller, ring_size=2**16, max_pending=2**20,
+                 max_file_bytes=2**26, search_size=2**20):
+
+        self.name = name
+        self.base = base
+        self.spiller = spiller
+        self.ring_size = ring_size
+        self.max_pending = max_pending
+        self.max_file_bytes = max_file_bytes
+        self.search_size = search_size
+
+        # ring holds the newest bytes; older ones go to pending until the
+        # spiller thread has compressed them into a segment file.
+        self.ring = collections.deque()
+        self.ring_start = 0
+        self.ring_bytes = 0
+        self.end = 0
+
+        # lock guards pending, segments and the counters against the spiller
+        # thread; spill_lock serialises whole spills, rotation and close.
+        self.lock = threading.Lock()
+        self.spill_lock = threading.Lock()
+        self.pending = collections.deque()
+        self.pending_bytes = 0
+        self.segments = []
+        self.spilled_bytes = 0
+        self.file_bytes = 0
+        self.old_file_bytes = 0
+        self.dropped_bytes = 0
+        self.released = False
+        self.closed = False
+
+        # One file per generation, base.<generation>.seg; rotation keeps the
+        # current and previous generation and unlinks anything older.
+        # Readers open the files themselves, so only the writer holds an fd.
+        self.generation = 0
+        self.fd = os.open(self.get_path(0), self.open_flags, 0o644)
+
+    def get_path(self, generation):
+
+        return f'{self.base}.{generation}.seg'
+
+    def append(self, data):
+
+        if not data:
+            return
+
+        self.ring.append(data)
+        self.ring_bytes += len(data)
+        self.end += len(data)
+
+        if self.ring_bytes > self.ring_size:
+            self.evict(self.ring_size // 2)
+
+    def evict(self, keep, drop=True):
+
+        start = self.ring_start
+        evicted = []
+        while self.ring_bytes > keep:
+            chunk = self.ring.popleft()
+            excess = self.ring_bytes - keep
+            if len(chunk) > excess:
+                # Split the boundary chunk so the ring keeps its newest bytes.
+                self.ring.appendleft(chunk[excess:])
+                chunk = chunk[:excess]
+            evicted.append(chunk)
+            self.ring_bytes -= len(chunk)
+            self.ring_start += len(chunk)
+        if not evicted:
+            return
+        batch = b''.join(evicted)
+
+        with self.lock:
+            self.pending.append((start, batch))
+            self.pending_bytes += len(batch)
+
+            # pending[0] may be in flight on the spiller thread, so only
+            # ever drop from behind it.
+            while drop and self.pending_bytes > self.max_pending and len(self.pending) > 1:
+                _, dropped = self.pending[1]
+                del self.pending[1]
+                self.pending_bytes -= len(dropped)
+                self.dropped_bytes += len(dropped)
+                logw(f'capture[{self.name}]: spill behind, dropped: {len(dropped)}')
+
+        self.spiller.submit(self.spill)
+
+    def spill(self):
+
+        with self.spill_lock:
+            if self.fd is not None:
+                self.spill_one()
+
+    def spill_one(self):
+
+        with self.lock:
+            if not self.pending:
+                return False
+            start, batch = self.pending[0]
+
+        compressed = zlib.compress(batch, self.compress_level)
+        segment = self.segment_header.pack(start, len(compressed)) + compressed
+        if self.file_bytes and self.file_bytes + len(segment) > self.max_file_bytes:
+            self.rotate()
+        os.write(self.fd, segment)
+
+        with self.lock:
+            self.pending.popleft()
+            self.pending_bytes -= len(batch)
+            pos = self.file_bytes + self.segment_header.size
+            self.segments.append((start, start + len(batch), pos, len(compressed), self.generation))
+            self.file_bytes = pos + len(compressed)
+            self.spilled_bytes += len(batch)
+
+        return True
+
+    def rotate(self):
+
+        log(f'capture[{self.name}]: rotate: {self.file_bytes}')
+
+        os.close(self.fd)
+        self.fd = os.open(self.get_path(self.generation + 1), self.open_flags, 0o644)
+        with self.lock:
+            self.generation += 1
+            self.segments = [s for s in self.segments if s[4] == self.generation - 1]
+            self.old_file_bytes = self.file_bytes
+            self.file_bytes = 0
+
+        try:
+            os.unlink(self.get_path(self.generation - 2))
+        except FileNotFoundError:
+            pass
+
+    def get_pieces(self, start):
+
+        # Contiguous (offset, data) pieces, oldest first, covering start
+        # onwards or back to the first gap left by dropped or rotated data.
+        # Segments are read without the lock; a generation rotated away
+        # meanwhile just ends the history there.
+        pieces = [(self.ring_start, b''.join(self.ring))]
+        with self.lock:
+            older = [(segment[0], segment[1], segment) for segment in self.segments]
+            older += [(s, s + len(data), data) for s, data in self.pending]
+
+        fds = {}
+        try:
+            for piece_start, piece_end, data in reversed(older):
+                if start >= pieces[0][0] or piece_end != pieces[0][0]:
+                    break
+                if isinstance(data, tuple):
+                    _, _, pos, length, generation = data
+                    if generation not in fds:
+                        try:
+                            fds[generation] = os.open(self.get_path(generation), os.O_RDONLY)
+                        except FileNotFoundError:
+                            break
+                    data = zlib.decompress(os.pread(fds[generation], length, pos))
+                pieces.insert(0, (piece_start, data))
+        finally:
+            for fd in fds.values():
+                os.close(fd)
+
+        return pieces
+
+    def tail(self, size):
+
+        start = max(self.end - size, 0)
+        pieces = self.get_pieces(start)
+        data = b''.join(data for _, data in pieces)
+
+        return data[max(start - pieces[0][0], 0):]
+
+    def search(self, pattern, size=None):
+
+        if size is None:
+            size = self.search_size
+        start = max(self.end - size, 0)
+        pieces = self.get_pieces(start)
+        base = max(start, pieces[0][0])
+        data = b''.join(data for _, data in pieces)[base - pieces[0][0]:]
+
+        if isinstance(pattern, str):
+            pattern = pattern.encode()
+
+        matches = []
+        line_end = -1
+        for match in re.finditer(pattern, data):
+            if match.start() <= line_end:
+                continue
+            line_start = data.rfind(b'\n', 0, match.start()) + 1
+            line_end = data.find(b'\n', match.end())
+            if line_end == -1:
+                line_end = len(data)
+            matches.append((base + line_start, data[line_start:line_end]))
+
+        return matches
+
+    def stats(self):
+
+        with self.lock:
+            return {
+                'total_bytes': self.end,
+                'ring_bytes': self.ring_bytes,
+                'pending_bytes': self.pending_bytes,
+                'memory_bytes': self.ring_bytes + self.pending_bytes,
+                'spilled_bytes': self.spilled_bytes,
+                'file_bytes': self.file_bytes + self.old_file_bytes,
+                'dropped_bytes': self.dropped_bytes,
+                'released': self.released,
+            }
+
+    def release(self):
+
+        # The stream has ended: move the ring out so everything reaches disk,
+        # and let the spiller finish writing. Queries keep working from the
+        # segment files until close().
+        self.released = True
+        self.evict(0, drop=False)
+        self.spiller.submit(self.finish)
+
+    def finish(self):
+
+        with self.spill_lock:
+            if self.fd is None:
+                return
+            while self.spill_one():
+                pass
+            os.close(self.fd)
+            self.fd = None
+
+    def close(self, unlink=True):
+
+        with self.spill_lock:
+            if self.closed:
+                return
+            self.closed = True
+            if self.fd is not None:
+                os.close(self.fd)
+                self.fd = None
+            with self.lock:
+                self.pending.clear()
+                self.pending_bytes = 0
+                self.segments = []
+
+            if unlink:
+                for generation in (self.generation - 1, self.generation):
+                    try:
+                        os.unlink(self.get_path(generation))
+                    except FileNotFoundError:
+                        pass
+
+
+class Spiller(threading.Thread):
+
+    def __init__(self):
+
+        threading.Thread.__init__(self, name='eventio-spiller', daemon=True)
+        self.queue = queue.Queue()
+
+    def submit(self, fn):
+
+        self.queue.put(fn)
+
+    def run(self):
+
+        while True:
+            fn = self.queue.get()
+            if fn is None:
+                break
+            try:
+                fn()
+            except OSError as e:
+                loge(f'spiller: {fn}: {e}')
+
+    def stop(self):
+
+        self.queue.put(None)
+        self.join()
+
+
+class Capturer(object):
+
+    def __init__(self, directory, ring_size=2**16, max_pending=2**20, max_file_bytes=2**26,
+                 search_size=2**20):
+
+        self.directory = directory
+        self.ring_size = ring_size
+        self.max_pending = max_pending
+        self.max_file_bytes = max_file_bytes
+        self.search_size = search_size
+        self.captures = {}
+        self.capture_seq = itertools.count()
+        self.spiller = Spiller()
+        self.spiller.start()
+
+        os.makedirs(directory, exist_ok=True)
+
+    def capture(self, name, stream):
+
+        key = (name, stream)
+        capture = self.captures.get(key)
+        if capture is not None and capture.released:
+            # A restarted child replaces its predecessor's output; each
+            # capture has its own files, so a close still queued for the old
+            # one cannot touch the new one.
+            log(f'capturer: {name}: {stream}: replacing released capture')
+            self.spiller.submit(capture.close)
+            capture = None
+
+        if capture is None:
+            base = os.path.join(self.directory, f'{name}.{stream}.{next(self.capture_seq)}')
+            log(f'capturer: {name}: {stream}: {base}')
+            capture = StreamCapture(
+                f'{name}.{stream}', base, self.spiller,
+                ring_size=self.ring_size, max_pending=self.max_pending,
+                max_file_bytes=self.max_file_bytes, search_size=self.search_size)
+            self.captures[key] = capture
+
+        return capture
+
+    def tail(self, name, stream, size):
+
+        return self.captures[(name, stream)].tail(size)
+
+    def search(self, name, pattern, size=None):
+
+        return {
+            stream: capture.search(pattern, size=size)
+            for (n, stream), capture in self.captures.items()
+            if n == name
+        }
+
+    def stats(self):
+
+        children = {}
+        for (name, stream), capture in self.captures.items():
+            child = children.setdefault(name, {'memory_bytes': 0})
+            child[stream] = capture.stats()
+            child['memory_bytes'] += child[stream]['memory_bytes']
+
+        return children
+
+    def release(self, name):
+
+        log(f'capturer: release: {name}')
+
+        for (n, _), capture in self.captures.items():
+            if n == name and not capture.released:
+                capture.release()
+
+    def discard(self, name, unlink=True):
+
+        log(f'capturer: discard: {name}: unlink: {unlink}')
+
+        for key in [key for key in self.captures if key[0] == name]:
+            capture = self.captures.pop(key)
+            self.spiller.submit(functools.partial(capture.close, unlink=unlink))
+
+    def close(self, unlink=False):
+
+        for capture in self.captures.values():
+            if not capture.released:
+                capture.release()
+        self.spiller.stop()
+        for capture in self.captures.values():
+            capture.close(unlink=unlink)
+        self.captures.clear()
+
+
+class CapturePopenHandler(proccer.PopenHandler):
+
+    def __init__(self, name, capturer, *popen_args, **popen_kwargs):
+
+        proccer.PopenHandler.__init__(self, name, *popen_args, **popen_kwargs)
+
+        self.capturer = capturer
+        self.stdout_capture = capturer.capture(name, 'stdout')
+        self.stderr_capture = capturer.capture(name, 'stderr')
+
+    def on_stdout(self, data):
+
+        logd(f'popen[{self.name}]: stdout: {len(data)}')
+        self.stdout_capture.append(data)
+
+    def on_stderr(self, data):
+
+        logd(f'popen[{self.name}]: stderr: {len(data)}')
+        self.stderr_capture.append(data)
+
+    def on_close(self):
+
+        proccer.PopenHandler.on_close(self)
+        self.capturer.release(self.name)
@@ -20,8 +20,8 @@
 # SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
 
 import functools
-import subprocess
-import sys
+
+from . import logfns as package_logfns
 
 
 log =  functools.partial(print, 'info   :', flush=True)
@@ -43,6 +43,11 @@ def set_logfns(i, w, e, d):
     logd = d
 
 
+# Pick up log functions set on the package before this module was imported.
+if package_logfns is not None:
+    set_logfns(*package_logfns)
+
+
 class LineMixin(object):
 
     def __init__(self, name):
@@ -55,8 +60,13 @@ class LineMixin(object):
         log(f'line[{self.__name}]: {line}')
 
     def on_flush_line(self):
-        
-        self.on_line(b''.join(self.__partial))
+
+        if not self.__partial:
+            return
+
+        line = b''.join(self.__partial)
+        self.__partial.clear()
+        self.on_line(line)
 
     def on_line_data(self, data):
 
@@ -22,10 +22,18 @@
 import bisect
 import functools
 import fcntl
+import itertools
 import os
 import select
 import time
 
+from . import logfns as package_logfns
+
+
+PRIO_HIGH = 0
+PRIO_NORMAL = 1
+PRIO_LOW = 2
+
 
 log =  functools.partial(print, 'info   :')
 logw = functools.partial(print, 'warning:')
@@ -46,8 +54,15 @@ def set_logfns(i, w, e, d):
     logd = d
 
 
+# Pick up log functions set on the package before this module was imported.
+if package_logfns is not None:
+    set_logfns(*package_logfns)
+
+
 class Handler(object):
 
+    priority = PRIO_NORMAL
+
     def __init__(self, name, fds=tuple()):
 
         self.name = name
@@ -66,7 +81,6 @@ class Handler(object):
         log(f'handler[{self.name}]: on closed fd: {fd}')
         if fd in self.fds:
             self.on_flush_fd(fd)
-            self.fds.discard(fd)
             self.poller.pop_fd(fd)
 
     def on_flush_fd(self, fd):
@@ -75,10 +89,11 @@ class Handler(object):
 
     def check_closed_fds(self):
 
-        for fd in self.fds:
+        for fd in list(self.fds):
             logd(f'{self.name}: checking fd: {fd}')
-            fcntl_ret = fcntl.fcntl(fd, fcntl.F_GETFD)
-            if fcntl_ret == -1:
+            try:
+                fcntl.fcntl(fd, fcntl.F_GETFD)
+            except OSError:
                 log(f'{self.name}: bad fd: {fd}')
                 self.poller.pop_fd(fd)
 
@@ -94,6 +109,10 @@ class Handler(object):
 
         self.poller = poller
 
+    def set_priority(self, priority):
+
+        self.priority = priority
+
     def on_readable(self, fd):
 
         logd(f'handler[{self.name}]: on readable')
@@ -162,10 +181,24 @@ class Handler(object):
 
         log(f'handler[{self.name}]: on run')
 
+    def on_drain(self):
+
+        logd(f'handler[{self.name}]: on drain')
+
+        return True
+
+    def on_close(self):
+
+        log(f'handler[{self.name}]: on close')
+
 
 class Poller(object):
 
     sizehint = 100
+    budget = 64
+    starve_limit = 16
+    drain_interval = .05
+    until_interval = .05
     ein = select.EPOLLIN
     eout = select.EPOLLOUT
     eerr = select.EPOLLERR
@@ -174,8 +207,19 @@ class Poller(object):
     def __init__(self):
 
         self.epoll = select.epoll(self.sizehint)
+        self.wakeup_read, self.wakeup_write = os.pipe()
+        os.set_blocking(self.wakeup_read, False)
+        os.set_blocking(self.wakeup_write, False)
+        self.epoll.register(self.wakeup_read, self.ein)
         self.handler_fds = {}
+        self.handlers = set()
+        self.unrun_handlers = set()
+        self.running = False
+        self.stop_requested = False
         self.timeouts = []
+        self.timeout_seq = itertools.count()
+        self.deferred = {}
+        self.starved = {}
 
     def add_handler(self, handler):
 
@@ -197,104 +241,237 @@ class Poller(object):
             self.epoll.register(fd, events)
 
         handler.set_poller(self)
+        self.handlers.add(handler)
+
+        if self.running:
+            handler.on_run()
+        else:
+            self.unrun_handlers.add(handler)
+
+    def close_handler(self, handler):
+
+        log(f'poller: close handler: {handler.name}')
+
+        self.handlers.discard(handler)
+        self.unrun_handlers.discard(handler)
+        handler.on_close()
+
+        if not self.handlers:
+            logw(f'poller: no more handlers')
 
     def pop_handler(self, handler):
 
         log(f'poller: pop handler: {handler.name}')
 
-        for fd in set(self.handler_fds):
-            self.handler_fds.pop(fd)
+        for fd in list(handler.fds):
+            self.pop_fd(fd)
 
-        if not len(self.handler_fds):
-            logw(f'poller: no more handlers')
-            raise SystemExit(0)
+        if handler in self.handlers:
+            self.close_handler(handler)
+
+    def pop_handlers(self):
+
+        for handler in list(self.handlers):
+            self.pop_handler(handler)
 
     def pop_fd(self, fd):
 
         log(f'poller: pop fd: {fd}')
 
-        if fd not in self.handler_fds:
+        handler = self.handler_fds.pop(fd, None)
+        if handler is None:
             logw(f'poller: missing handler for fd: {fd}')
-        for fd in set(self.handler_fds):
-            handler = self.handler_fds.pop(fd)
-            log(f'poller: pop fd -> {handler.name}')
+            return
+        log(f'poller: pop fd -> {handler.name}')
 
-        if not len(self.handler_fds):
-            logw(f'poller: no more handlers')
-            raise SystemExit(0)
+        try:
+            self.epoll.unregister(fd)
+        except OSError:
+            logd(f'poller: fd already closed: {fd}')
+        self.deferred.pop(fd, None)
+
+        handler.fds.discard(fd)
+        if not handler.fds and handler in self.handlers:
+            self.close_handler(handler)
+
+    def dispatch_key(self, fd):
+
+        handler = self.handler_fds.get(fd)
+        priority = handler.priority if handler else PRIO_HIGH
+        age = self.deferred.get(fd, 0)
+
+        # Aging: an fd deferred starve_limit times is promoted ahead of every
+        # class, so lower classes still get a share under sustained load.
+        if age >= self.starve_limit:
+            priority = PRIO_HIGH - 1
+
+        return priority, -age, fd
+
+    def dispatch_events(self, fd, handler, events):
+
+        done_events = 0
+        if events & self.ein:
+            logd(f'poller: {handler.name}: in: {self.ein}')
+            handler.on_readable(fd)
+            done_events += self.ein
+        if events & self.eout:
+            logd(f'poller: {handler.name}: out: {self.eout}')
+            handler.on_writeable(fd)
+            done_events += self.eout
+        if events & self.eerr:
+            logd(f'poller: {handler.name}: err: {self.eerr}')
+            handler.on_errorable(fd)
+            done_events += self.eerr
+        if events & self.ehup:
+            logd(f'poller: {handler.name}: hup: {self.ehup}')
+            handler.on_hupable(fd)
+            done_events += self.ehup
+        if events & ~done_events:
+            loge(f'poller: {handler.name}: {fd}: {events}: {done_events}: left over events: 0x{events & ~done_events:08x}')
+            handler.on_closed_fd(fd)
+
+    def defer_fd(self, fd, handler, deferred):
+
+        age = self.deferred.get(fd, 0) + 1
+        deferred[fd] = age
+        logd(f'poller: {handler.name}: deferred fd: {fd}: {age}')
+
+        if age == self.starve_limit:
+            self.starved[handler.name] = self.starved.get(handler.name, 0) + 1
+            logw(f'poller: {handler.name}: starving fd: {fd}: deferred {age} iterations')
+
+    def run_timeouts(self):
+
+        now = time.monotonic()
+        num_timeouts = 0
+        for deadline, _, fn, args, kwargs, in self.timeouts:
+            if deadline > now:
+                break
+            num_timeouts += 1
+            fn(now, *args, **kwargs)
+
+        if num_timeouts:
+            self.timeouts = self.timeouts[num_timeouts:]
 
     def run_one(self, timeout=None):
 
-        if self.timeouts:
+        if self.deferred:
+            timeout = 0
+        elif self.timeouts:
             now = time.monotonic()
             if timeout is None:
                 timeout = 1.
             timeout_deadline = timeout + now
-            soonest_deadline, _, _, _ = self.timeouts[0]
+            soonest_deadline, _, _, _, _ = self.timeouts[0]
             deadline = min(soonest_deadline, timeout_deadline)
-            timeout = deadline - now
+            timeout = max(deadline - now, 0)
 
         polls = self.epoll.poll(timeout=timeout)
+
+        self.run_timeouts()
+
+        ready = sorted(polls, key=lambda poll: self.dispatch_key(poll[0]))
         used_handlers = set()
-        for fd, events in polls:
+        deferred = {}
+        spent = 0
+        for fd, events in ready:
+            if fd == self.wakeup_read:
+                self.clear_wakeup()
+                continue
+
             handler = self.handler_fds.get(fd)
+            if not handler:
+                continue
+
+            if handler.priority > PRIO_HIGH:
+                if spent >= self.budget:
+                    self.defer_fd(fd, handler, deferred)
+                    continue
+                spent += 1
+
             used_handlers.add(handler)
-            done_events = 0
-            if handler:
-                if events & self.ein:
-                    logd(f'poller: {handler.name}: in: {self.ein}')
-                    handler.on_readable(fd)
-                    done_events += self.ein
-                if events & self.eout:
-                    logd(f'poller: {handler.name}: out: {self.eout}')
-                    handler.on_writeable(fd)
-                    done_events += self.eout
-                if events & self.eerr:
-                    logd(f'poller: {handler.name}: err: {self.eerr}')
-                    handler.on_errorable(fd)
-                    done_events += self.eerr
-                if events & self.ehup:
-                    logd(f'poller: {handler.name}: hup: {self.ehup}')
-                    handler.on_hupable(fd)
-                    done_events += self.ehup
-                if events & ~done_events:
-                    loge(f'poller: {handler.name}: {fd}: {events}: {done_events}: left over events: 0x{events & ~done_events:08x}')
-                    handler.on_closed_fd(fd)
+            self.dispatch_events(fd, handler, events)
+        self.deferred = deferred
+
         for handler in used_handlers:
             handler.check_closed_fds()
 
-        now = time.monotonic()
-        num_timeouts = 0
-        for deadline, fn, args, kwargs, in self.timeouts:
-            if deadline > now:
-                break
-            num_timeouts += 1
-            fn(now, *args, **kwargs)
-
-        if num_timeouts:
-            self.timeouts = self.timeouts[num_timeouts:]
-
-    def run(self):
+    def run(self, until=None):
 
         log(f'poller: running...')
-        handlers = set()
-        for fd, handler in self.handler_fds.items():
-            handlers.add(handler)
+        self.running = True
 
+        handlers, self.unrun_handlers = self.unrun_handlers, set()
         for handler in handlers:
             handler.on_run()
 
         try:
-            while True:
-                self.run_one()
+            while not self.stop_requested and self.handlers:
+                if until is not None and until():
+                    break
+                self.run_one(timeout=None if until is None else self.until_interval)
         except KeyboardInterrupt:
             pass
-        except SystemExit:
-            pass
+        finally:
+            self.running = False
+            self.stop_requested = False
 
         log(f'poller: ... finished')
 
+    def stop(self):
+
+        log(f'poller: stopping')
+
+        # Kept until run() sees it, so a stop() during setup is not lost.
+        self.stop_requested = True
+        self.wakeup()
+
+    def wakeup(self):
+
+        try:
+            os.write(self.wakeup_write, b'\0')
+        except BlockingIOError:
+            pass
+
+    def clear_wakeup(self):
+
+        try:
+            while os.read(self.wakeup_read, 2**12):
+                pass
+        except BlockingIOError:
+            pass
+
+    def drain(self, timeout=1.):
+
+        log(f'poller: draining...')
+
+        deadline = time.monotonic() + timeout
+        pending = set(self.handlers)
+        while True:
+            pending = {h for h in pending if h in self.handlers and not h.on_drain()}
+            now = time.monotonic()
+            if not pending or now >= deadline:
+                break
+            self.run_one(timeout=min(self.drain_interval, deadline - now))
+
+        for handler in pending:
+            logw(f'poller: {handler.name}: not drained')
+
+        log(f'poller: ... drained: {not pending}')
+
+        return not pending
+
+    def close(self):
+
+        log(f'poller: close')
+
+        self.stop()
+        self.pop_handlers()
+        self.epoll.close()
+        os.close(self.wakeup_read)
+        os.close(self.wakeup_write)
+
     def add_timeout(self, fn, from_now, args=tuple(), kwargs=dict()):
 
         deadline = time.monotonic() + from_now
-        bisect.insort(self.timeouts, (deadline, fn, args, kwargs))
+        bisect.insort(self.timeouts, (deadline, next(self.timeout_seq), fn, args, kwargs))
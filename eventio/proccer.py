@@ -23,7 +23,7 @@ import functools
 import subprocess
 
 from . import poller
-from . import stdio
+from . import logfns as package_logfns
 
 
 log =  functools.partial(print, 'info   :', flush=True)
@@ -45,8 +45,15 @@ def set_logfns(i, w, e, d):
     logd = d
 
 
+# Pick up log functions set on the package before this module was imported.
+if package_logfns is not None:
+    set_logfns(*package_logfns)
+
+
 class PopenHandler(poller.Handler):
 
+    reap_interval = .1
+
     def __init__(self, name, *popen_args, **popen_kwargs):
 
         popen_kwargs['stdin'] = subprocess.PIPE
@@ -85,9 +92,23 @@ class PopenHandler(poller.Handler):
 
         log(f'popen[{self.name}]: stderr: {data}')
 
+    def close_stdin(self):
+
+        if self.stdin.closed:
+            return
+
+        log(f'popen[{self.name}]: closing stdin')
+        self.poller.pop_fd(self.stdin.fileno())
+        try:
+            self.stdin.close()
+        except OSError as e:
+            logw(f'popen[{self.name}]: stdin close: {e}')
+
     def on_stdout_event(self):
 
         data = self.stdout.read(2**16)
+        if data is None:
+            return
         if not len(data):
             self.poller.pop_fd(self.stdout.fileno())
         else:
@@ -96,6 +117,8 @@ class PopenHandler(poller.Handler):
     def on_stderr_event(self):
 
         data = self.stderr.read(2**16)
+        if data is None:
+            return
         if not len(data):
             self.poller.pop_fd(self.stderr.fileno())
         else:
@@ -108,4 +131,49 @@ class PopenHandler(poller.Handler):
         elif fd == self.stderr.fileno():
             self.on_stderr_event()
         else:
-            loge('popen[{self.name}]: unknown fd readable: {fd}')
+            loge(f'popen[{self.name}]: unknown fd readable: {fd}')
+
+    def on_errorable(self, fd):
+
+        if not self.stdin.closed and fd == self.stdin.fileno():
+            logw(f'popen[{self.name}]: stdin error')
+            self.close_stdin()
+        else:
+            poller.Handler.on_errorable(self, fd)
+
+    def on_drain(self):
+
+        if self.stdin.closed:
+            return True
+
+        try:
+            self.stdin.flush()
+        except BlockingIOError:
+            return False
+        except OSError as e:
+            logw(f'popen[{self.name}]: stdin flush: {e}')
+
+        return True
+
+    def on_close(self):
+
+        log(f'popen[{self.name}]: on close')
+
+        for pipe in (self.stdin, self.stdout, self.stderr):
+            try:
+                pipe.close()
+            except OSError as e:
+                logw(f'popen[{self.name}]: pipe close: {e}')
+
+        self.on_reap()
+
+    def on_reap(self, now=None):
+
+        # Poll rather than wait so a child that outlives its pipes does not
+        # block the loop; it is reaped on a later timer instead.
+        returncode = self.popen.poll()
+        if returncode is None:
+            logd(f'popen[{self.name}]: not exited yet')
+            self.poller.add_timeout(self.on_reap, self.reap_interval)
+        else:
+            log(f'popen[{self.name}]: exited: {returncode}')
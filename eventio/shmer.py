@@ -0,0 +1,438 @@
+# Copyright 2021 "Dan Farrell <djfarrell@hopspan.com>"
+# 
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+# 
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+# 
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT.
+# IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY
+# CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT,
+# TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+import functools
+import os
+import struct
+
+from multiprocessing import resource_tracker
+from multiprocessing import shared_memory
+
+from . import poller
+from . import proccer
+from . import logfns as package_logfns
+
+
+log =  functools.partial(print, 'info   :', flush=True)
+logw = functools.partial(print, 'warning:', flush=True)
+loge = functools.partial(print, 'error  :', flush=True)
+logd = functools.partial(print, 'debug  :', flush=True)
+
+
+ENV_NAME = 'EVENTIO_SHM'
+
+
+def set_logfns(i, w, e, d):
+
+    global log
+    global logw
+    global loge
+    global logd
+
+    log = i
+    logw = w
+    loge = e
+    logd = d
+
+
+# Pick up log functions set on the package before this module was imported.
+if package_logfns is not None:
+    set_logfns(*package_logfns)
+
+
+def attach_shm(name):
+
+    # Attaching must not register the segment with this process's resource
+    # tracker, or it gets unlinked under the owner when we exit.
+    try:
+        return shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:
+        shm = shared_memory.SharedMemory(name=name)
+        resource_tracker.unregister(shm._name, 'shared_memory')
+        return shm
+
+
+def ring_doorbell(fd):
+
+    try:
+        os.write(fd, b'\0')
+    except BlockingIOError:
+        pass
+
+
+def clear_doorbell(fd):
+
+    try:
+        while os.read(fd, 2**12):
+            pass
+    except BlockingIOError:
+        pass
+
+
+class Ring(object):
+
+    # head and tail are free-running byte counters on separate cache lines;
+    # only the producer stores head and only the consumer stores tail.
+    # Records are a 4-byte length and payload padded to 4 bytes, so a header
+    # never wraps. The counters are published with plain stores and no
+    # fences: that payload-then-head (and read-then-tail) ordering holds on
+    # x86's total store order but is not guaranteed on weaker memory models
+    # such as ARM.
+    header_size = 128
+    head_offset = 0
+    size_offset = 8
+    tail_offset = 64
+    counter = struct.Struct('<Q')
+    length = struct.Struct('<I')
+
+    def __init__(self, name=None, size=2**20):
+
+        if name is None:
+            if size <= 0 or size & (size - 1):
+                raise ValueError(f'ring size must be a power of two: {size}')
+            self.shm = shared_memory.SharedMemory(create=True, size=self.header_size + size)
+            self.owner = True
+            self.counter.pack_into(self.shm.buf, self.size_offset, size)
+        else:
+            self.shm = attach_shm(name)
+            self.owner = False
+            size, = self.counter.unpack_from(self.shm.buf, self.size_offset)
+
+        self.name = self.shm.name
+        self.size = size
+        self.mask = size - 1
+        self.data = self.shm.buf[self.header_size:self.header_size + size]
+
+        # Each side caches the counter only it stores, and the producer the
+        # last tail it saw, to save a shared read per record.
+        self.write_head = self.head
+        self.read_tail = self.tail
+        self.seen_tail = self.read_tail
+
+    @property
+    def head(self):
+
+        return self.counter.unpack_from(self.shm.buf, self.head_offset)[0]
+
+    @property
+    def tail(self):
+
+        return self.counter.unpack_from(self.shm.buf, self.tail_offset)[0]
+
+    def is_empty(self):
+
+        return self.head == self.tail
+
+    def need(self, length):
+
+        return (self.length.size + length + 3) & ~3
+
+    def put(self, counter, data):
+
+        pos = counter & self.mask
+        first = min(len(data), self.size - pos)
+        self.data[pos:pos + first] = data[:first]
+        if first < len(data):
+            self.data[:len(data) - first] = data[first:]
+
+    def get(self, counter, length):
+
+        pos = counter & self.mask
+        end = pos + length
+        if end <= self.size:
+            return bytes(self.data[pos:end])
+
+        return bytes(self.data[pos:]) + bytes(self.data[:end - self.size])
+
+    def write(self, data):
+
+        if not isinstance(data, bytes):
+            data = memoryview(data).cast('B')
+        length = len(data)
+        need = self.need(length)
+        if need > self.size:
+            raise ValueError(f'record too large for ring: {length}')
+
+        head = self.write_head
+        if self.size - (head - self.seen_tail) < need:
+            self.seen_tail = self.tail
+            if self.size - (head - self.seen_tail) < need:
+                return False
+
+        pos = head & self.mask
+        self.length.pack_into(self.data, pos, length)
+        start = pos + self.length.size
+        if start + length <= self.size:
+            self.data[start:start + length] = data
+        else:
+            self.put(head + self.length.size, data)
+
+        self.write_head = head + need
+        self.counter.pack_into(self.shm.buf, self.head_offset, self.write_head)
+
+        return True
+
+    def read_records(self):
+
+        # Everything up to one head read, with a single tail store at the end.
+        tail = self.read_tail
+        head = self.head
+        records = []
+        while tail != head:
+            pos = tail & self.mask
+            length, = self.length.unpack_from(self.data, pos)
+            start = pos + self.length.size
+            if start + length <= self.size:
+                records.append(self.data[start:start + length].tobytes())
+            else:
+                records.append(self.get(tail + self.length.size, length))
+            tail += self.need(length)
+
+        if records:
+            self.read_tail = tail
+            self.counter.pack_into(self.shm.buf, self.tail_offset, tail)
+
+        return records
+
+    def close(self):
+
+        self.data.release()
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
+
+
+class RingMixin(object):
+
+    retry_interval = .001
+
+    def __init__(self, name, rx, tx, rx_fd, tx_fd):
+
+        self.__name = name
+        self.__rx = rx
+        self.__tx = tx
+        self.__rx_fd = rx_fd
+        self.__tx_fd = tx_fd
+        self.__pending = []
+        self.__retrying = False
+        self.__closed = False
+
+    def is_doorbell_fd(self, fd):
+
+        return fd == self.__rx_fd
+
+    def on_record(self, data):
+
+        log(f'ring[{self.__name}]: record: {data}')
+
+    def on_doorbell(self):
+
+        # Clear before draining so a ring that lands mid-drain stays pending.
+        clear_doorbell(self.__rx_fd)
+
+        records = self.__rx.read_records()
+        while records:
+            for data in records:
+                self.on_record(data)
+            records = self.__rx.read_records()
+
+    def send_record(self, data):
+
+        self.flush_records()
+        if self.__pending or not self.write_record(data):
+            logd(f'ring[{self.__name}]: full, pending: {len(self.__pending)}')
+            self.__pending.append(data)
+            self.schedule_retry()
+
+    def write_record(self, data):
+
+        head = self.__tx.write_head
+        if not self.__tx.write(data):
+            return False
+
+        # Only wake the consumer on an empty to non-empty transition. tail is
+        # read after head is published, so a consumer that saw the ring empty
+        # is always rung.
+        if self.__tx.tail == head:
+            ring_doorbell(self.__tx_fd)
+
+        return True
+
+    def flush_records(self):
+
+        sent = 0
+        for data in self.__pending:
+            if not self.write_record(data):
+                break
+            sent += 1
+        del self.__pending[:sent]
+
+    def schedule_retry(self):
+
+        if not self.__retrying:
+            self.__retrying = True
+            self.poller.add_timeout(self.on_retry, self.retry_interval)
+
+    def on_retry(self, now):
+
+        self.__retrying = False
+        if self.__closed:
+            return
+
+        self.flush_records()
+        if self.__pending:
+            self.schedule_retry()
+
+    def on_drain_records(self):
+
+        self.flush_records()
+
+        return not self.__pending
+
+    def close_doorbell(self):
+
+        if self.__tx_fd is not None:
+            if not self.__closed:
+                self.flush_records()
+            if self.__pending:
+                logw(f'ring[{self.__name}]: closing with pending records: {len(self.__pending)}')
+                self.__pending.clear()
+            os.close(self.__tx_fd)
+            self.__tx_fd = None
+
+    def close_rings(self):
+
+        if self.__closed:
+            return
+
+        self.close_doorbell()
+        self.__closed = True
+        os.close(self.__rx_fd)
+        self.__rx.close()
+        self.__tx.close()
+
+
+class ShmPopenHandler(proccer.PopenHandler, RingMixin):
+
+    ring_size = 2**20
+
+    def __init__(self, name, *popen_args, **popen_kwargs):
+
+        tx = Ring(size=self.ring_size)
+        rx = Ring(size=self.ring_size)
+        child_rx_fd, tx_fd = os.pipe()
+        rx_fd, child_tx_fd = os.pipe()
+
+        env = os.environ if popen_kwargs.get('env') is None else popen_kwargs['env']
+        env = dict(env)
+        env[ENV_NAME] = f'{tx.name}:{rx.name}:{child_rx_fd}:{child_tx_fd}'
+        popen_kwargs['env'] = env
+        popen_kwargs['pass_fds'] = tuple(popen_kwargs.get('pass_fds', ())) + (child_rx_fd, child_tx_fd)
+
+        self.fds = {rx_fd}
+        try:
+            proccer.PopenHandler.__init__(self, name, *popen_args, **popen_kwargs)
+        except BaseException:
+            os.close(rx_fd)
+            os.close(tx_fd)
+            tx.close()
+            rx.close()
+            raise
+        finally:
+            os.close(child_rx_fd)
+            os.close(child_tx_fd)
+
+        os.set_blocking(tx_fd, False)
+        RingMixin.__init__(self, name, rx, tx, rx_fd, tx_fd)
+
+    def on_stdin(self, data):
+
+        logd(f'shm[{self.name}]: stdin: {len(data)}')
+        self.send_record(data)
+
+    def close_stdin(self):
+
+        self.close_doorbell()
+        proccer.PopenHandler.close_stdin(self)
+
+    def on_readable(self, fd):
+
+        if self.is_doorbell_fd(fd):
+            self.on_doorbell()
+        else:
+            proccer.PopenHandler.on_readable(self, fd)
+
+    def on_flush_fd(self, fd):
+
+        if self.is_doorbell_fd(fd):
+            self.on_doorbell()
+
+    def on_drain(self):
+
+        return self.on_drain_records() and proccer.PopenHandler.on_drain(self)
+
+    def on_close(self):
+
+        proccer.PopenHandler.on_close(self)
+        self.close_rings()
+
+
+class ShmChildHandler(poller.Handler, RingMixin):
+
+    def __init__(self, name='__shm__', env=None):
+
+        env = os.environ if env is None else env
+        rx_name, tx_name, rx_fd, tx_fd = env[ENV_NAME].split(':')
+        rx_fd = int(rx_fd)
+        tx_fd = int(tx_fd)
+
+        poller.Handler.__init__(self, name, fds=rx_fd)
+        os.set_blocking(tx_fd, False)
+        RingMixin.__init__(self, name, Ring(rx_name), Ring(tx_name), rx_fd, tx_fd)
+
+    def on_stdin(self, data):
+
+        log(f'shm[{self.name}]: stdin: {data}')
+
+    def write(self, data):
+
+        self.send_record(data)
+
+    def on_record(self, data):
+
+        self.on_stdin(data)
+
+    def on_readable(self, fd):
+
+        self.on_doorbell()
+
+    def on_flush_fd(self, fd):
+
+        self.on_doorbell()
+
+    def on_drain(self):
+
+        return self.on_drain_records()
+
+    def on_close(self):
+
+        poller.Handler.on_close(self)
+        self.close_rings()
@@ -0,0 +1,138 @@
+# Copyright 2021 "Dan Farrell <djfarrell@hopspan.com>"
+# 
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+# 
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+# 
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT.
+# IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY
+# CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT,
+# TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+
+import functools
+import os
+import signal
+
+from . import poller
+from . import logfns as package_logfns
+
+
+log =  functools.partial(print, 'info   :', flush=True)
+logw = functools.partial(print, 'warning:', flush=True)
+loge = functools.partial(print, 'error  :', flush=True)
+logd = functools.partial(print, 'debug  :', flush=True)
+
+
+def set_logfns(i, w, e, d):
+
+    global log
+    global logw
+    global loge
+    global logd
+
+    log = i
+    logw = w
+    loge = e
+    logd = d
+
+
+# Pick up log functions set on the package before this module was imported.
+if package_logfns is not None:
+    set_logfns(*package_logfns)
+
+
+def signal_name(signum):
+
+    # Realtime signals have no Signals member, so fall back to the number.
+    try:
+        return signal.Signals(signum).name
+    except ValueError:
+        return f'signal {signum}'
+
+
+def on_signal_frame(signum, frame):
+
+    # The C level handler has already written signum to the wakeup fd, so
+    # there is nothing to do between bytecodes; dispatch happens in the loop.
+    pass
+
+
+class SignalHandler(poller.Handler):
+
+    priority = poller.PRIO_HIGH
+
+    def __init__(self, name='__signal__', signums=tuple()):
+
+        read_fd, self.wakeup_fd = os.pipe()
+        os.set_blocking(self.wakeup_fd, False)
+
+        poller.Handler.__init__(self, name, fds=read_fd)
+
+        self.read_fd = read_fd
+        self.callbacks = {}
+        self.previous = {}
+        self.previous_wakeup_fd = signal.set_wakeup_fd(self.wakeup_fd, warn_on_full_buffer=False)
+
+        for signum in signums:
+            self.add_signal(signum)
+
+    def add_signal(self, signum, fn=None):
+
+        log(f'{self.name}: add signal: {signal_name(signum)}')
+
+        if fn is not None:
+            self.callbacks[signum] = fn
+        if signum not in self.previous:
+            self.previous[signum] = signal.signal(signum, on_signal_frame)
+
+    def on_signal(self, signum, count):
+
+        fn = self.callbacks.get(signum)
+        if fn is None:
+            log(f'{self.name}: {signal_name(signum)}: {count}')
+        else:
+            fn(signum, count)
+
+    def on_readable(self, fd):
+
+        # A burst of the same signal is coalesced into one callback with a
+        # count, in order of first arrival.
+        counts = {}
+        try:
+            while True:
+                data = os.read(fd, 2**12)
+                if not data:
+                    break
+                for signum in data:
+                    counts[signum] = counts.get(signum, 0) + 1
+        except BlockingIOError:
+            pass
+
+        for signum, count in counts.items():
+            logd(f'{self.name}: signal: {signum}: {count}')
+            self.on_signal(signum, count)
+
+    def on_close(self):
+
+        poller.Handler.on_close(self)
+
+        for signum, previous in self.previous.items():
+            signal.signal(signum, previous)
+        self.previous.clear()
+
+        if signal.set_wakeup_fd(self.previous_wakeup_fd) != self.wakeup_fd:
+            logw(f'{self.name}: wakeup fd replaced while installed')
+
+        os.close(self.wakeup_fd)
+        os.close(self.read_fd)
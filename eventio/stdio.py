@@ -19,13 +19,13 @@
 # TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
 # SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
 
-import binascii
 import functools
-import subprocess
+import os
 import sys
 
 from . import poller
 from . import liner
+from . import logfns as package_logfns
 
 
 log =  functools.partial(print, 'info   :', flush=True)
@@ -47,8 +47,15 @@ def set_logfns(i, w, e, d):
     logd = d
 
 
+# Pick up log functions set on the package before this module was imported.
+if package_logfns is not None:
+    set_logfns(*package_logfns)
+
+
 class StdioBaseHandler(poller.Handler):
 
+    priority = poller.PRIO_HIGH
+
     def __init__(self, name, stdin, stdout=None, stderr=None):
 
         fds = {
@@ -100,17 +107,19 @@ class StdioBaseHandler(poller.Handler):
     def on_readable(self, fd):
 
         logd(f'{self.name}: on readable: {fd}')
-        data = self.stdin.read(2**16)
-        if isinstance(data, str):
-            data = data.encode()
+        try:
+            data = os.read(fd, 2**16)
+        except BlockingIOError:
+            return
 
-        logd(f'{self.name}: on readable: {fd}: {len(data)}: {binascii.b2a_hex(data)}')
+        logd(f'{self.name}: on readable: {fd}: {len(data)}')
         if not len(data):
             logw(f'{self.name}: closing')
             self.on_stdin_closed()
-        elif b'\x0d' in data or self.stdin.closed:
+        elif b'\x0d' in data:
             self.on_stdin(data[:data.find(b'\x0d')])
-            raise SystemExit(0)
+            self.poller.stop()
+            return
         else:
             self.on_stdin(data)
 
@@ -120,7 +129,7 @@ class StdioBaseHandler(poller.Handler):
 
     def on_errorable(self, fd):
 
-        loge(f'handler[{self.__name__}]: on error')
+        loge(f'handler[{self.name}]: on error')
 
 class StdioHandler(StdioBaseHandler):
 
@@ -139,6 +148,12 @@ class StdioBaseLineHandler(StdioBaseHandler, liner.LineMixin):
 
         self.on_flush_line()
 
+    def on_drain(self):
+
+        self.on_flush_line()
+
+        return True
+
     def on_stdin_closed(self):
 
         self.on_flush_line()
@@ -153,5 +168,5 @@ class StdioLineHandler(StdioBaseLineHandler, liner.LineMixin):
 
     def __init__(self):
 
-        StdioBaseHandler.__init__(self, '__stdin_line__', sys.stdin)
+        StdioBaseHandler.__init__(self, '__stdin_line__', sys.stdin.buffer)
         liner.LineMixin.__init__(self, self.name)
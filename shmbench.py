@@ -0,0 +1,206 @@
+# Copyright 2021 "Dan Farrell <djfarrell@hopspan.com>"
+# 
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+# 
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+# 
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT.
+# IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY
+# CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT,
+# TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+import argparse
+import fcntl
+import os
+import struct
+import sys
+import time
+
+import eventio
+
+
+# Both paths echo length-prefixed records through the same Python child,
+# so the only difference measured is the transport.
+length = struct.Struct('<I')
+pipe_capacity = 2**20
+
+
+def nolog(*args, **kwargs):
+
+    pass
+
+
+class RecordReader(object):
+
+    def __init__(self):
+
+        self.buf = b''
+
+    def feed(self, data):
+
+        buf = self.buf + data
+        records = []
+        pos = 0
+        while len(buf) - pos >= length.size:
+            size, = length.unpack_from(buf, pos)
+            end = pos + length.size + size
+            if end > len(buf):
+                break
+            records.append(buf[pos + length.size:end])
+            pos = end
+        self.buf = buf[pos:]
+
+        return records
+
+
+class PipeEcho(eventio.Handler):
+
+    def __init__(self):
+
+        eventio.Handler.__init__(self, '__pipe_echo__', fds=sys.stdin.fileno())
+        self.reader = RecordReader()
+        self.stdout = sys.stdout.buffer
+
+    def on_readable(self, fd):
+
+        data = os.read(fd, 2**16)
+        if not data:
+            self.poller.pop_fd(fd)
+            return
+
+        for record in self.reader.feed(data):
+            self.stdout.write(length.pack(len(record)) + record)
+        self.stdout.flush()
+
+
+class BenchMixin(object):
+
+    def __init__(self, args):
+
+        self.record = b'x' * args.size
+        self.window = args.window
+        self.expected = args.count
+        self.sent = 0
+        self.received = 0
+
+    def on_run(self):
+
+        self.pump()
+
+    def pump(self):
+
+        while self.sent < self.expected and self.sent - self.received < self.window:
+            self.send(self.record)
+            self.sent += 1
+
+    def on_received(self, records):
+
+        self.received += records
+        if self.received >= self.expected:
+            self.close_stdin()
+        else:
+            self.pump()
+
+
+class PipeBench(BenchMixin, eventio.PopenHandler):
+
+    def __init__(self, args):
+
+        eventio.PopenHandler.__init__(self, '__pipe__', [sys.executable, __file__, '--child', 'pipe'])
+        BenchMixin.__init__(self, args)
+        self.reader = RecordReader()
+
+        for pipe in (self.stdin, self.stdout):
+            fcntl.fcntl(pipe.fileno(), fcntl.F_SETPIPE_SZ, pipe_capacity)
+
+    def send(self, record):
+
+        self.on_stdin(length.pack(len(record)) + record)
+
+    def on_stdout(self, data):
+
+        self.on_received(len(self.reader.feed(data)))
+
+
+class ShmBench(BenchMixin, eventio.ShmPopenHandler):
+
+    def __init__(self, args):
+
+        eventio.ShmPopenHandler.__init__(self, '__shm__', [sys.executable, __file__, '--child', 'shm'])
+        BenchMixin.__init__(self, args)
+
+    def send(self, record):
+
+        self.on_stdin(record)
+
+    def on_record(self, data):
+
+        self.on_received(1)
+
+
+def child(transport):
+
+    poller = eventio.Poller()
+    if transport == 'pipe':
+        handler = PipeEcho()
+    else:
+        handler = eventio.ShmChildHandler()
+        handler.on_stdin = handler.write
+    poller.add_handler(handler)
+
+    poller.run()
+
+
+def bench(name, handler_cls, args):
+
+    poller = eventio.Poller()
+    handler = handler_cls(args)
+    poller.add_handler(handler)
+
+    start = time.perf_counter()
+    poller.run()
+    elapsed = time.perf_counter() - start
+
+    total = args.count * args.size
+    print(f'{name:5}: {args.count} x {args.size} bytes, window {args.window}: {elapsed:.3f}s: '
+          f'{args.count / elapsed:.0f} records/s: {total / elapsed / 2**20:.1f} MiB/s', flush=True)
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description='round trip records through a python echo child over pipes and shared memory')
+    parser.add_argument('--count', type=int, default=100000)
+    parser.add_argument('--size', type=int, default=256)
+    parser.add_argument('--window', type=int, default=64)
+    parser.add_argument('--child', choices=('pipe', 'shm'), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    eventio.set_logfns(nolog, nolog, nolog, nolog)
+
+    if args.child:
+        return child(args.child)
+
+    # PopenHandler writes straight into the pipe, so the shared window has to
+    # fit in the pipe buffer; keep half of it spare since partly filled pages
+    # count against the capacity.
+    window = max(pipe_capacity // 2 // (length.size + args.size), 1)
+    if args.window > window:
+        print(f'window capped to pipe capacity: {args.window} -> {window}')
+        args.window = window
+
+    bench('pipe', PipeBench, args)
+    bench('shm', ShmBench, args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
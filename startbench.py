@@ -0,0 +1,108 @@
+# Copyright 2021 "Dan Farrell <djfarrell@hopspan.com>"
+# 
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+# 
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+# 
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT.
+# IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY
+# CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT,
+# TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+
+here = os.path.dirname(os.path.abspath(__file__))
+
+
+def import_times(stmt):
+
+    proc = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', stmt],
+        cwd=here, stderr=subprocess.PIPE, stdout=subprocess.DEVNULL, check=True)
+
+    times = {}
+    for line in proc.stderr.decode().splitlines():
+        if not line.startswith('import time:') or '|' not in line:
+            continue
+        _, cumulative, name = line.split('|')
+        if not cumulative.strip().isdigit():
+            continue
+        times[name.strip()] = int(cumulative)
+
+    return times
+
+
+def wall_time(stmt):
+
+    code = f'import time; start = time.perf_counter(); {stmt}; print(time.perf_counter() - start)'
+    proc = subprocess.run(
+        [sys.executable, '-c', code],
+        cwd=here, stdout=subprocess.PIPE, check=True)
+
+    return float(proc.stdout)
+
+
+def first_event(script):
+
+    start = time.perf_counter()
+    proc = subprocess.Popen(
+        [sys.executable, script], cwd=here,
+        stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+    proc.stdin.write(b'ping\n')
+    proc.stdin.flush()
+
+    for line in proc.stdout:
+        if b'ping' in line and b'stdout' in line:
+            break
+    elapsed = time.perf_counter() - start
+
+    proc.stdin.close()
+    proc.stdout.close()
+    proc.wait()
+
+    return elapsed
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description='import and first event latency of eventio tools')
+    parser.add_argument('--runs', type=int, default=20)
+    parser.add_argument('--top', type=int, default=5, help='slowest cumulative imports to show')
+    args = parser.parse_args()
+
+    stmts = {
+        'import eventio': 'import eventio',
+        'catter imports': 'import eventio; eventio.Poller, eventio.PopenHandler, eventio.StdioHandler',
+    }
+    for label, stmt in stmts.items():
+        walls = [wall_time(stmt) for _ in range(args.runs)]
+        print(f'{label:15}: median {statistics.median(walls) * 1000:.2f}ms', flush=True)
+
+        runs = [import_times(stmt) for _ in range(args.runs)]
+        names = sorted(set().union(*runs), key=lambda n: -statistics.median(r.get(n, 0) for r in runs))
+        for name in names[:args.top]:
+            print(f'    {name:30}: {statistics.median(r.get(name, 0) for r in runs) / 1000:.2f}ms')
+
+    script = os.path.join(here, 'catter.py')
+    runs = [first_event(script) for _ in range(args.runs)]
+    print(f'{"catter.py":15}: first event median {statistics.median(runs) * 1000:.2f}ms, max {max(runs) * 1000:.2f}ms')
+
+
+if __name__ == '__main__':
+    sys.exit(main())